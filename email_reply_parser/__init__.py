@@ -5,6 +5,14 @@
 """
 
 import re
+import sys
+
+# Line tags, combined as bitmasks over the rows of an email message
+_QUOTED = 1
+_HEADER = 2
+_QUOTE_HDR = 4
+_BLANK = 8
+_SIG = 16
 
 
 class EmailReplyParser(object):
@@ -29,26 +37,67 @@ class EmailReplyParser(object):
 
             Returns reply body message
         """
-        return EmailReplyParser.read(text).reply
+        return EmailMessage(text).read_reply()
+
+    @staticmethod
+    def parse_many(texts, workers=None, chunksize=64):
+        """ Provides the reply portion of many emails, parsed in parallel
+            across worker processes.
+
+            texts - An iterable of string email bodies
+            workers - Number of worker processes, defaults to the number of CPUs
+            chunksize - Number of emails sent to a worker at a time, ignored before Python 3.5
+
+            Returns a list of reply body messages, in the order of texts
+        """
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            # Executor.map only takes chunksize from Python 3.5
+            if sys.version_info >= (3, 5):
+                replies = executor.map(EmailReplyParser.parse_reply, texts, chunksize=chunksize)
+            else:
+                replies = executor.map(EmailReplyParser.parse_reply, texts)
+            return list(replies)
 
 
 class EmailMessage(object):
     """ An email message represents a parsed email body.
     """
 
-    SIG_REGEX = re.compile(r'(--|__|-\w)|(^Sent from my (\w+\s*){1,3})')
+    __slots__ = ('fragments', 'fragment', 'text', 'found_visible', 'lines', '_hidden_start')
+
+    _SIG_REGEX = r'(?:--|__|-\w|Sent from my (?:\w+\s*){1,3})'
+    # QUOTED_REGEX and HEADER_REGEX aren't used for parsing since they were folded into
+    # LINE_CLASS_REGEX below; they are kept for backward compatibility only
+    SIG_REGEX = re.compile('^' + _SIG_REGEX)
     QUOTE_HDR_REGEX = re.compile('On.*wrote:$')
     QUOTED_REGEX = re.compile(r'(>+)')
     HEADER_REGEX = re.compile(r'^\*?(From|Sent|To|Subject):\*? .+')
-    _MULTI_QUOTE_HDR_REGEX = r'(?!On.*On\s.+?wrote:)(On\s(.+?)wrote:)'
-    MULTI_QUOTE_HDR_REGEX = re.compile(_MULTI_QUOTE_HDR_REGEX, re.DOTALL | re.MULTILINE)
-    MULTI_QUOTE_HDR_REGEX_MULTILINE = re.compile(_MULTI_QUOTE_HDR_REGEX, re.DOTALL)
+    # QUOTE_HDR_REGEX, QUOTED_REGEX, HEADER_REGEX and SIG_REGEX fused into one pass. No line
+    # matches two alternatives: quote_hdr needs 'On' and quoted needs '>' at the start, and header
+    # needs a ':' right after the keyword, which 'Sent from my' never has. Lines led by whitespace
+    # can only be signatures; _tag_lines checks those with SIG_REGEX on the lstripped line.
+    LINE_CLASS_REGEX = re.compile(
+        r'^(?:(?P<quote_hdr>On.*wrote:$)|(?P<quoted>>+)|(?P<header>\*?(?:From|Sent|To|Subject):\*? .+)|'
+        r'(?P<sig>' + _SIG_REGEX + '))')
+    LINE_CLASS_TAGS = {'quote_hdr': _QUOTE_HDR | _HEADER, 'quoted': _QUOTED, 'header': _HEADER, 'sig': _SIG}
+    # Every LINE_CLASS_REGEX match starts with one of these characters
+    LINE_CLASS_STARTS = 'O>*FST-_'
+    # The cheap (?=On\s) guard keeps the backtracking lookahead from running at every 'On'
+    _MULTI_QUOTE_HDR_REGEX = r'(?=On\s)(?!On.*On\s.+?wrote:)(On\s(.+?)wrote:)'
+    MULTI_QUOTE_HDR_REGEX = re.compile(_MULTI_QUOTE_HDR_REGEX, re.DOTALL)
+    # Starts on the literal newline so the search can skip ahead between newlines
+    OUTLOOK_FIX_REGEX = re.compile(r'\n(?<=[^\n]\n)(?= ?[_-]{7})')
 
     def __init__(self, text):
         self.fragments = []
         self.fragment = None
+        # str.replace hands back text itself when there are no CRLFs to normalize, and
+        # replace + str.split is several times faster than splitting on a \r?\n regex
         self.text = text.replace('\r\n', '\n')
         self.found_visible = False
+        self._hidden_start = 0
 
     def read(self):
         """ Creates new fragment for each line
@@ -59,58 +108,166 @@ class EmailMessage(object):
 
         self.found_visible = False
 
-        is_multi_quote_header = self.MULTI_QUOTE_HDR_REGEX_MULTILINE.search(self.text)
-        if is_multi_quote_header:
-            self.text = self.MULTI_QUOTE_HDR_REGEX.sub(is_multi_quote_header.groups()[0].replace('\n', ''), self.text)
+        self._split_lines()
 
-        # Fix any outlook style replies, with the reply immediately above the signature boundary line
-        #   See email_2_2.txt for an example
-        self.text = re.sub('([^\n])(?=\n ?[_-]{7,})', '\\1\n', self.text, re.MULTILINE)
+        # Fragments come bottom up, so fill the list from its end to have them in reading order
+        fragments = self._group_fragments(self._tag_lines())
+        self.fragments = [None] * len(fragments)
+        self._hidden_start = len(fragments)
+        for position, (start, end, tag) in zip(range(len(fragments) - 1, -1, -1), fragments):
+            self.fragment = Fragment(bool(tag & _QUOTED), start, end, headers=bool(tag & _HEADER))
+            self.fragment.signature = bool(tag & _SIG)
+            self._finish_fragment(position)
 
-        self.lines = self.text.split('\n')
-        self.lines.reverse()
+        for f in self.fragments[self._hidden_start:]:
+            f.hidden = True
 
-        for line in self.lines:
-            self._scan_line(line)
+        return self
+
+    def read_reply(self):
+        """ Labels lines like read(), but only builds the reply message,
+            without creating a fragment for each part of the email.
 
-        self._finish_fragment()
+            Returns reply body message
+        """
+        self._split_lines()
 
-        self.fragments.reverse()
+        self.found_visible = False
 
-        return self
+        lines = self.lines
+        reply = []
+        for start, end, tag in self._group_fragments(self._tag_lines()):
+            if tag & _HEADER:
+                # Everything below a headers fragment is hidden
+                del reply[:]
+            hidden = self._is_hidden(tag & _QUOTED, tag & _HEADER, tag & _SIG,
+                                     lambda: '\n'.join(lines[start:end]).strip())
+            if not (hidden or tag & _QUOTED):
+                reply.append('\n'.join(lines[start:end]).strip())
+
+        reply.reverse()
+        return '\n'.join(reply)
+
+    def _split_lines(self):
+        """ Joins multi line quote headers, separates outlook style
+            signature boundaries and splits the text into lines.
+        """
+        # Nothing past the last 'wrote:' can take part in a multi line quote header, so bound
+        # the match there rather than letting the lookahead backtrack over the rest of the email
+        quote_hdr_end = self.text.rfind('wrote:') + len('wrote:')
+        is_multi_quote_header = quote_hdr_end >= len('wrote:') and \
+            self.MULTI_QUOTE_HDR_REGEX.search(self.text, 0, quote_hdr_end)
+        if is_multi_quote_header:
+            # The lookahead rules out any later header, so this is the only match to join into one line
+            self.text = self.text[:is_multi_quote_header.start()] + \
+                is_multi_quote_header.group(1).replace('\n', '') + \
+                self.text[is_multi_quote_header.end():]
+
+        # Fix any outlook style replies, with the reply immediately above the signature boundary line
+        #   See email_2_2.txt for an example
+        # Each boundary line starts with '_' or '-', possibly after one space; most emails have none
+        text = self.text
+        if '\n_' in text or '\n-' in text or '\n _' in text or '\n -' in text:
+            self.text = self.OUTLOOK_FIX_REGEX.sub('\n\n', text)
+
+        self.lines = self.text.split('\n')
 
     @property
     def reply(self):
         """ Captures reply message within email
         """
-        reply = []
-        for f in self.fragments:
-            if not (f.hidden or f.quoted):
-                reply.append(f.content)
-        return '\n'.join(reply)
+        return '\n'.join(self.reply_iter())
 
-    def _scan_line(self, line):
-        """ Reviews each line in email message and determines fragment type
+    def reply_iter(self):
+        """ Lazily yields each part of the reply message within email,
+            for callers that don't need it joined into one string.
+        """
+        return (f.content for f in self.fragments if not (f.hidden or f.quoted))
+
+    def _tag_lines(self):
+        """ Reviews each line in email message and determines its type
 
-            line - a row of text from an email message
+            Returns a list with a bitmask of line tags for each line
         """
-        is_quote_header = self.QUOTE_HDR_REGEX.match(line) is not None
-        is_quoted = self.QUOTED_REGEX.match(line) is not None
-        is_header = is_quote_header or self.HEADER_REGEX.match(line) is not None
+        match = self.LINE_CLASS_REGEX.match
+        sig_match = self.SIG_REGEX.match
+        line_class_tags = self.LINE_CLASS_TAGS
+        line_class_starts = self.LINE_CLASS_STARTS
+        tags = []
+        append = tags.append
+        for line in self.lines:
+            # Most lines are told apart by their first character alone
+            first = line[:1]
+            if first == '>':
+                append(_QUOTED)
+                continue
+            if first.isspace():
+                # Strip rather than match \s, which only covers ASCII whitespace in
+                # unicode lines on Python 2
+                if line.isspace():
+                    append(_BLANK)
+                elif sig_match(line.lstrip()):
+                    append(_SIG)
+                else:
+                    append(0)
+                continue
+            if first and first not in line_class_starts:
+                append(0)
+                continue
+
+            line_class = match(line)
+            if line_class:
+                append(line_class_tags[line_class.lastgroup])
+            elif not line:
+                append(_BLANK)
+            else:
+                append(0)
+        return tags
 
-        if self.fragment and len(line.strip()) == 0:
-            if self.SIG_REGEX.match(self.fragment.lines[-1].strip()):
-                self.fragment.signature = True
-                self._finish_fragment()
+    @staticmethod
+    def _group_fragments(tags):
+        """ Groups tagged lines into fragments. Lines are scanned bottom up,
+            as signatures and quoted blocks are recognised by what follows them.
 
-        if self.fragment \
-                and ((self.fragment.headers == is_header and self.fragment.quoted == is_quoted) or
-                         (self.fragment.quoted and (is_quote_header or len(line.strip()) == 0))):
+            tags - a bitmask of line tags for each line of an email message
 
-            self.fragment.lines.append(line)
-        else:
-            self._finish_fragment()
-            self.fragment = Fragment(is_quoted, line, headers=is_header)
+            Returns a list of (start, end, tag) line ranges from the bottom of the
+            email up, where tag holds the fragment's quoted, header and signature bits
+        """
+        fragments = []
+        append = fragments.append
+        kind = None
+        end = len(tags)
+        tag = 0
+        for index in range(len(tags) - 1, -1, -1):
+            # below is the tag of the line just scanned, the top line of the current fragment
+            tag, below = tags[index], tag
+
+            if kind is not None and tag & _BLANK and below & _SIG:
+                append((index + 1, end, kind | _SIG))
+                kind = None
+
+            line_kind = tag & (_QUOTED | _HEADER)
+            if kind is not None \
+                    and (kind == line_kind or (kind & _QUOTED and tag & (_QUOTE_HDR | _BLANK))):
+                continue
+
+            if kind is not None:
+                append((index + 1, end, kind))
+            kind = line_kind
+            end = index + 1
+
+        if kind is not None:
+            append((0, end, kind))
+        return fragments
+
+    def __getstate__(self):
+        # Slotted classes have no __dict__ for the default protocol 0 pickling on Python 2
+        return dict((name, getattr(self, name)) for name in self.__slots__ if hasattr(self, name))
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 
     def quote_header(self, line):
         """ Determines whether line is part of a quoted area
@@ -121,55 +278,80 @@ class EmailMessage(object):
         """
         return self.QUOTE_HDR_REGEX.match(line[::-1]) is not None
 
-    def _finish_fragment(self):
+    def _finish_fragment(self, position):
         """ Creates fragment
-        """
 
-        if self.fragment:
-            self.fragment.finish()
-            if self.fragment.headers:
-                # Regardless of what's been seen to this point, if we encounter a headers fragment,
-                # all the previous fragments should be marked hidden and found_visible set to False.
-                self.found_visible = False
-                for f in self.fragments:
-                    f.hidden = True
-            if not self.found_visible:
-                if self.fragment.quoted \
-                        or self.fragment.headers \
-                        or self.fragment.signature \
-                        or (len(self.fragment.content.strip()) == 0):
-
-                    self.fragment.hidden = True
-                else:
-                    self.found_visible = True
-            self.fragments.append(self.fragment)
+            position - index of the fragment within fragments
+        """
+        fragment = self.fragment
+        if fragment:
+            fragment.finish(self.lines[fragment.start:fragment.end])
+            if fragment.headers:
+                # read() hides the previous fragments once every fragment is finished
+                self._hidden_start = position + 1
+            fragment.hidden = self._is_hidden(fragment.quoted, fragment.headers, fragment.signature,
+                                              lambda: fragment.content)
+            self.fragments[position] = fragment
         self.fragment = None
 
+    def _is_hidden(self, quoted, headers, signature, content):
+        """ Determines whether the next fragment up the email is hidden,
+            for both read() and read_reply()
+
+            quoted, headers, signature - the fragment's labels
+            content - a function returning the fragment's stripped content,
+                only called when the result depends on it
+
+            Returns True or False
+        """
+        if headers:
+            # Regardless of what's been seen to this point, if we encounter a headers fragment,
+            # all the previous fragments should be marked hidden and found_visible set to False.
+            # Hiding the previous fragments is left to the caller.
+            self.found_visible = False
+        if self.found_visible:
+            return False
+        if quoted or headers or signature or not content():
+            return True
+        self.found_visible = True
+        return False
+
 
 class Fragment(object):
     """ A Fragment is a part of
         an Email Message, labeling each part.
     """
 
-    def __init__(self, quoted, first_line, headers=False):
+    __slots__ = ('signature', 'headers', 'hidden', 'quoted', '_content', 'start', 'end')
+
+    def __init__(self, quoted, start, end, headers=False):
         self.signature = False
         self.headers = headers
         self.hidden = False
         self.quoted = quoted
         self._content = None
-        self.lines = [first_line]
+        self.start = start
+        self.end = end
 
-    def finish(self):
+    def finish(self, lines):
         """ Creates block of content with lines
             belonging to fragment.
+
+            lines - the rows of the email message from start to end
         """
-        self.lines.reverse()
-        self._content = '\n'.join(self.lines)
-        self.lines = None
+        self._content = '\n'.join(lines).strip()
 
     @property
     def content(self):
-        return self._content.strip()
+        return self._content
+
+    def __getstate__(self):
+        # Slotted classes have no __dict__ for the default protocol 0 pickling on Python 2
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
 # Colour constants
 bold=`tput bold`
 green=`tput setaf 2`
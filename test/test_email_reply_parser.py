@@ -1,4 +1,5 @@
 import os
+import pickle
 import sys
 import unittest
 import re
@@ -8,6 +9,11 @@ import time
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from email_reply_parser import EmailReplyParser
 
+try:
+    import concurrent.futures
+except ImportError:
+    concurrent = None
+
 
 class EmailMessageTest(unittest.TestCase):
     def test_simple_body(self):
@@ -122,6 +128,11 @@ class EmailMessageTest(unittest.TestCase):
         message = self.get_email('email_1_2')
         self.assertTrue("You can list the keys for the bucket" in message.reply)
 
+    def test_reply_iter(self):
+        message = self.get_email('email_1_2')
+        self.assertEqual(message.fragments[0].content, next(message.reply_iter()))
+        self.assertEqual(message.reply, '\n'.join(message.reply_iter()))
+
     def test_reply_from_gmail(self):
         with open('test/emails/email_gmail.txt') as f:
             self.assertEqual('This is a test for inbox replying to a github message.',
@@ -141,6 +152,45 @@ class EmailMessageTest(unittest.TestCase):
                 "Outlook with a reply above headers using unusual format",
                 EmailReplyParser.parse_reply(f.read()))
 
+    def test_outlook_fix_applies_to_every_boundary_line(self):
+        text = '\n'.join('reply %d\n________________________________' % i for i in range(10))
+        message = EmailReplyParser.read(text)
+        self.assertEqual(text.count('\n') + 10, message.text.count('\n'))
+
+    def test_parse_reply_matches_read_reply(self):
+        for name in os.listdir('test/emails'):
+            with open(os.path.join('test/emails', name)) as f:
+                text = f.read()
+            self.assertEqual(EmailReplyParser.read(text).reply, EmailReplyParser.parse_reply(text), name)
+
+    def test_parse_many(self):
+        if concurrent is None:
+            return
+        texts = []
+        for name in sorted(os.listdir('test/emails')):
+            with open(os.path.join('test/emails', name)) as f:
+                texts.append(f.read())
+        self.assertEqual([EmailReplyParser.parse_reply(text) for text in texts],
+                         EmailReplyParser.parse_many(texts, workers=2, chunksize=4))
+
+    def test_fragments_pickle(self):
+        message = self.get_email('email_1_2')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            fragments = pickle.loads(pickle.dumps(message.fragments, protocol))
+            self.assertEqual(
+                [(f.content, f.quoted, f.signature, f.hidden) for f in message.fragments],
+                [(f.content, f.quoted, f.signature, f.hidden) for f in fragments]
+            )
+
+    def test_message_pickle(self):
+        message = self.get_email('email_1_2')
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            self.assertEqual(message.reply, pickle.loads(pickle.dumps(message, protocol)).reply)
+
+    def test_signature_after_unicode_whitespace(self):
+        self.assertEqual(u'Hello', EmailReplyParser.parse_reply(u'Hello\n\n\xa0-- \nsig'))
+        self.assertEqual(u'Hello', EmailReplyParser.parse_reply(u'Hello\n\n\u3000Sent from my iPhone'))
+
     def test_sent_from_iphone(self):
         with open('test/emails/email_iPhone.txt') as email:
             self.assertTrue("Sent from my iPhone" not in EmailReplyParser.parse_reply(email.read()))
@@ -180,11 +230,20 @@ class EmailMessageTest(unittest.TestCase):
             [fragment.hidden for fragment in message.fragments]
         )
 
+    def test_multiline_quote_header_keeps_backslashes(self):
+        message = EmailReplyParser.read('Reply\n\nOn Mon, C:\\1 <a@b.c>\nwrote:\n\n> Quoted')
+        self.assertTrue('On Mon, C:\\1 <a@b.c>wrote:' in message.fragments[1].content)
+
     def test_pathological_emails(self):
         t0 = time.time()
         message = self.get_email("pathological")
         self.assertTrue(time.time() - t0 < 1, "Took too long")
 
+    def test_many_on_lines_without_quote_header(self):
+        t0 = time.time()
+        EmailReplyParser.read('On the list\n' * 1000)
+        self.assertTrue(time.time() - t0 < 1, "Took too long")
+
     def test_doesnt_remove_signature_delimiter_in_mid_line(self):
         message = self.get_email('email_sig_delimiter_in_middle_of_line')
         self.assertEqual(1, len(message.fragments))